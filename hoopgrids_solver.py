@@ -1,16 +1,51 @@
+import asyncio
 from dataclasses import dataclass, field
 import datetime
 import json
+from operator import attrgetter
+import os
+from pathlib import Path
 import re
 import requests
-from typing import Any
+from requests.adapters import HTTPAdapter
+import tempfile
+from typing import Any, Optional
+from urllib3.util.retry import Retry
 
+import aiohttp
 import click
 import unidecode
 
+try:
+	import orjson
+	json_loads = orjson.loads
+except ImportError:
+	json_loads = json.loads
+
 
 SITE_URL = 'https://hoopgrids.com'
 FIRST_GRID_DATE = datetime.datetime(2023, 7, 4)
+CACHE_DIR = Path.home() / '.cache' / 'hoopgrids'
+PLAYERS_CACHE_VERSION = 1
+
+SCRIPT_SRC_RE = re.compile(rb'<script src="(main\.[^"]*?\.js)"')
+# the name is matched as a sequence of non quote chars or escapes, so the scan is
+# linear and escaped quotes do not cut the name.
+PLAYER_RE = re.compile(r'\{\s*id:\s*((\d+)(?:e(\d+))?),\s*name:\s*"((?:[^"\\\n]|\\.)*)"')
+# ascii folding of the latin ranges used by players names, taken from unidecode once
+# so names can be folded with str.translate. other chars still go through unidecode.
+ACCENT_TABLE = str.maketrans({
+	chr(code_point): unidecode.unidecode(chr(code_point))
+	for code_point in range(0xC0, 0x250)
+})
+PLAYER_VOTES_SORT_KEY = attrgetter('votes', 'player_data.name')
+
+REQUEST_TIMEOUT = 30
+REQUEST_RETRIES = 3
+REQUEST_BACKOFF_FACTOR = 0.3
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=Retry(total=REQUEST_RETRIES, backoff_factor=REQUEST_BACKOFF_FACTOR)))
 
 
 @dataclass
@@ -37,101 +72,234 @@ class Grid:
 	cells: list[Cell]
 
 
-def fetch_main_script() -> str:
+def fetch_main_script_name() -> str:
+	print('fetching main script name...')
+	main_site_resp = SESSION.get(SITE_URL, timeout=REQUEST_TIMEOUT).content
+	script_name = SCRIPT_SRC_RE.search(main_site_resp).group(1).decode()
+	return script_name
+
+
+def fetch_main_script(script_name: str) -> str:
 	print('fetching main script...')
-	main_site_resp = requests.get(SITE_URL).text
-	script_pattern = r'<script src="(main\..*?\.js)"'
-	script_name = re.findall(script_pattern, main_site_resp)[0]
-	main_script = requests.get(f'{SITE_URL}/{script_name}').text
+	main_script = SESSION.get(f'{SITE_URL}/{script_name}', timeout=REQUEST_TIMEOUT).text
 	return main_script
 
 
 def fetch_players(main_script: str) -> dict[str, PlayerData]:
 	print('fetching players...')
-	player_pattern = r'\{\s*id:\s*((\d+)(?:e(\d+))?),\s*name:\s*"(.*?)"'
-	players_matches = re.findall(player_pattern, main_script)
+	players_matches = PLAYER_RE.findall(main_script)
 	players = {}
 	for player_full_id, id_before_e, id_after_e, player_name in players_matches:
 		if id_after_e != '':
 			player_full_id = str(int(id_before_e) * (10 ** int(id_after_e)))
 		int(player_full_id)
 		player_name = player_name.encode().decode('unicode-escape')
-		player_name = unidecode.unidecode(player_name)
+		player_name = player_name.translate(ACCENT_TABLE)
+		if not player_name.isascii():
+			player_name = unidecode.unidecode(player_name)
 		players[player_full_id] = PlayerData(player_full_id, player_name)
 	return players
 
 
+def write_cache_file(cache_file: Path, data: bytes):
+	# write to a temp file and move it into place, so an interrupted write never
+	# leaves a truncated cache file behind. the cache is only an optimization, so a
+	# failed write is reported and ignored.
+	try:
+		CACHE_DIR.mkdir(parents=True, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=f'{cache_file.name}.', suffix='.tmp')
+		try:
+			try:
+				f = os.fdopen(fd, 'wb')
+			except BaseException:
+				os.close(fd)
+				raise
+			with f:
+				f.write(data)
+			os.replace(tmp_path, cache_file)
+		except BaseException:
+			os.unlink(tmp_path)
+			raise
+	except OSError as e:
+		print(f'could not write cache {cache_file}: {e}')
+
+
+def read_players_cache(cache_file: Path) -> Optional[dict[str, PlayerData]]:
+	try:
+		with open(cache_file, 'rb') as f:
+			cached_players = json_loads(f.read())
+	except (OSError, ValueError):
+		return None
+	if not isinstance(cached_players, dict) or not cached_players or not all(isinstance(name, str) for name in cached_players.values()):
+		return None
+	return {
+		player_id: PlayerData(player_id, name)
+		for player_id, name in cached_players.items()
+	}
+
+
+def load_players() -> dict[str, PlayerData]:
+	# the main script name is content hashed, so the players extracted from it
+	# can be cached until the site is redeployed. bump PLAYERS_CACHE_VERSION whenever
+	# the players extraction changes.
+	script_name = fetch_main_script_name()
+	cache_file = CACHE_DIR / f'players_v{PLAYERS_CACHE_VERSION}_{script_name}.json'
+	if cache_file.exists():
+		print(f'loading players from cache {cache_file}...')
+		players = read_players_cache(cache_file)
+		if players is not None:
+			return players
+		print(f'cache {cache_file} is invalid, fetching players again...')
+	main_script = fetch_main_script(script_name)
+	players = fetch_players(main_script)
+	write_cache_file(cache_file, json.dumps({player_id: p.name for player_id, p in players.items()}).encode())
+	return players
+
+
+def get_current_grid_date() -> str:
+	current_grid_date = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+	return current_grid_date.strftime('%d-%m-%Y')
+
+
 def get_date_code(date_str: str) -> int:
 	d = datetime.datetime.strptime(date_str, '%d-%m-%Y')
 	return (d - FIRST_GRID_DATE).days
 
 
-def get_cell_votes(day_code: int, players: dict[str, PlayerData], cell_code: str) -> list[PlayerDataWithVotes]:
+async def fetch_api_async(session: aiohttp.ClientSession, url: str) -> bytes:
+	# same retry policy as the requests session: connection errors, timeouts and
+	# server errors are retried with backoff, client errors are raised right away.
+	for attempt in range(REQUEST_RETRIES + 1):
+		try:
+			async with session.get(url) as r:
+				r.raise_for_status()
+				return await r.read()
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			if attempt == REQUEST_RETRIES or (isinstance(e, aiohttp.ClientResponseError) and e.status < 500):
+				raise
+			await asyncio.sleep(REQUEST_BACKOFF_FACTOR * (2 ** attempt))
+
+
+async def get_cell_votes_async(session: aiohttp.ClientSession, day_code: int, cell_code: str) -> bytes:
 	print(f'fetching cell {cell_code} votes...')
 	votes_url = f'https://api.hoopgrids.com/gamestat/{day_code+2}/playerselection/{cell_code}'
-	resp = requests.get(votes_url).text
-	votes = json.loads(json.loads(resp)['playerCounts'])
+	return await fetch_api_async(session, votes_url)
+
+
+def parse_cell_votes(votes_resp: bytes, players: dict[str, PlayerData]) -> list[PlayerDataWithVotes]:
+	votes = json_loads(json_loads(votes_resp)['playerCounts'])
 	to_ret = []
 	for player_id, votes in votes:
 		to_ret.append(PlayerDataWithVotes(players[player_id], votes))
 	return to_ret
 
 
-def complete_players_without_votes(valid_players: list[PlayerData], voted_players: list[PlayerDataWithVotes]) -> list[PlayerDataWithVotes]:
-	voted_players_set = {
-		p.player_data.player_id
+def merge_players_votes(valid_players: list[PlayerData], voted_players: list[PlayerDataWithVotes]) -> list[PlayerDataWithVotes]:
+	merged = {
+		p.player_data.player_id: p
 		for p in voted_players
 	}
-	to_ret = []
 	for p in valid_players:
-		if p.player_id not in voted_players_set:
-			to_ret.append(PlayerDataWithVotes(p, 0))
-	return to_ret
+		merged.setdefault(p.player_id, PlayerDataWithVotes(p, 0))
+	return sorted(merged.values(), key=PLAYER_VOTES_SORT_KEY)
 
 
-def get_cell(day_code: int, row: int, col: int, 
-		grid_data: dict[str, Any], players: dict[str, PlayerData]) -> Cell:
+def get_cell(row: int, col: int, grid_data: dict[str, Any], 
+		players: dict[str, PlayerData], votes_resp: bytes) -> Cell:
 	cell_code = f'{row}-{col}'
-	print(f'fetching cell {cell_code}...')
+	print(f'building cell {cell_code}...')
 	cell_players = grid_data[cell_code]['players']
 	cell_players = [
 		players[p_id]
 		for p_id in cell_players
 	]
-	cell_votes = get_cell_votes(day_code, players, cell_code)
-	cell_votes.extend(complete_players_without_votes(cell_players, cell_votes))
-	cell_votes = sorted(cell_votes, key=lambda p: (p.votes, p.player_data.name))
+	cell_votes = merge_players_votes(cell_players, parse_cell_votes(votes_resp, players))
 	return Cell(cell_code, cell_players, cell_votes)
 
 
-def get_grid(day_code: int, players: dict[str, PlayerData]) -> Grid:
-	print(f'building the grid for day {day_code}...')
+def is_valid_grid_data(grid_data: Any) -> bool:
+	return isinstance(grid_data, dict) and all(
+		isinstance(grid_data.get(f'{row}-{col}'), dict)
+		and isinstance(grid_data[f'{row}-{col}'].get('players'), list)
+		for row in range(0, 3)
+		for col in range(0, 3)
+	)
+
+
+def read_grid_cache(cache_file: Path) -> Optional[dict[str, Any]]:
+	try:
+		with open(cache_file, 'rb') as f:
+			grid_data = json_loads(f.read())
+	except (OSError, ValueError):
+		return None
+	return grid_data if is_valid_grid_data(grid_data) else None
+
+
+async def get_grid_data_async(session: aiohttp.ClientSession, day_code: int) -> dict[str, Any]:
+	# a published grid never changes, so past grids definitions are fetched once per
+	# day code. the current grid is not cached in case it is not fully published yet.
+	# the votes keep changing and are always fetched.
+	cache_file = CACHE_DIR / f'game_{day_code}.json'
+	cacheable = day_code < get_date_code(get_current_grid_date())
+	if cacheable and cache_file.exists():
+		print(f'loading grid from cache {cache_file}...')
+		grid_data = read_grid_cache(cache_file)
+		if grid_data is not None:
+			return grid_data
+		print(f'cache {cache_file} is invalid, fetching grid again...')
 	grid_url = f'https://api.hoopgrids.com/game/{day_code}'
-	resp = requests.get(grid_url).text
-	grid_data = json.loads(resp)
-	grid_cells = []
-	for row in range(0, 3):
-		for col in range(0, 3):
-			grid_cells.append(get_cell(day_code, row, col, grid_data, players))
+	resp = await fetch_api_async(session, grid_url)
+	grid_data = json_loads(resp)
+	if cacheable and is_valid_grid_data(grid_data):
+		write_cache_file(cache_file, resp)
+	return grid_data
+
+
+async def get_grid(day_code: int, players: dict[str, PlayerData]) -> Grid:
+	print(f'building the grid for day {day_code}...')
+	cells_positions = [
+		(row, col)
+		for row in range(0, 3)
+		for col in range(0, 3)
+	]
+	# the grid definition and the cells votes are independent, so fetch all of them
+	# concurrently over a single connection pool.
+	# trust_env keeps honoring proxy env vars and .netrc like the requests session does.
+	async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16), trust_env=True,
+			timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
+		grid_data, *votes_resps = await asyncio.gather(
+			get_grid_data_async(session, day_code),
+			*[
+				get_cell_votes_async(session, day_code, f'{row}-{col}')
+				for row, col in cells_positions
+			]
+		)
+	grid_cells = [
+		get_cell(row, col, grid_data, players, votes_resp)
+		for (row, col), votes_resp in zip(cells_positions, votes_resps)
+	]
 	return Grid(grid_cells)
 
 
 def display_grid(grid_date: str, grid: Grid) -> str:
-	valid_players_str = ''
-	sorted_players_votes_str = ''
+	valid_players_parts = []
+	sorted_players_votes_parts = []
 	for cell in grid.cells:
-		valid_players_names = [p.name for p in cell.valid_players]
-		valid_players_str += f'Cell {cell.cell_code}:\n\n'
-		valid_players_str += '\n'.join(valid_players_names)
-		valid_players_str += '\n\n*******************\n\n'
-		players_with_votes_names = [
+		valid_players_parts.append(f'Cell {cell.cell_code}:\n\n')
+		valid_players_parts.append('\n'.join(p.name for p in cell.valid_players))
+		valid_players_parts.append('\n\n*******************\n\n')
+		sorted_players_votes_parts.append(f'Cell {cell.cell_code}:\n\n')
+		sorted_players_votes_parts.append('\n'.join(
 			f'{p.player_data.name} - {p.votes}'
 			for p in cell.players_votes
-		]
-		sorted_players_votes_str += f'Cell {cell.cell_code}:\n\n'
-		sorted_players_votes_str += '\n'.join(players_with_votes_names)
-		sorted_players_votes_str += '\n\n*******************\n\n'
-	to_ret = f'Results for {grid_date}:\n\n{valid_players_str}$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$\n\nSorted by votes: \n\n{sorted_players_votes_str}'
+		))
+		sorted_players_votes_parts.append('\n\n*******************\n\n')
+	to_ret = ''.join([
+		f'Results for {grid_date}:\n\n',
+		*valid_players_parts,
+		'$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$\n\nSorted by votes: \n\n',
+		*sorted_players_votes_parts,
+	])
 	return to_ret
 
 
@@ -139,14 +307,12 @@ def display_grid(grid_date: str, grid: Grid) -> str:
 @click.argument('grid_date', required=False, default='Today')
 def main(grid_date: str):
 	if grid_date.lower() == 'today':
-		current_grid_date = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-		grid_date = current_grid_date.strftime('%d-%m-%Y')
+		grid_date = get_current_grid_date()
 	print(f'requested grid date: {grid_date}.')
 	day_code = get_date_code(grid_date)
 	print(f'requested grid date code: {day_code}.')
-	main_script = fetch_main_script()
-	players = fetch_players(main_script)
-	grid = get_grid(day_code, players)
+	players = load_players()
+	grid = asyncio.run(get_grid(day_code, players))
 	output = display_grid(grid_date, grid)
 	output_file_name = f'hoopgrids_solved_{grid_date}.txt'
 	with open(output_file_name, 'w') as f: